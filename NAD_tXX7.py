@@ -1,8 +1,17 @@
 
+import os
 import sys
+import math
+import heapq
+import bisect
+import select
 import time
+import types
+import threading
 import serial
-from collections import namedtuple
+from collections import deque, namedtuple
+# asyncio, concurrent.futures and logging are imported where they are used, as they
+# would otherwise dominate the import time of this module
 
 
 if sys.version_info.major < 3:
@@ -13,11 +22,199 @@ if sys.version_info.major < 3:
 Variable = namedtuple('variable', ['description', 'possible_values', 'operators'])
 Variable.__new__.__defaults__ = ('=+-?',)
 
+# Compiled form of a Variable, see compile_specification
+CompiledVariable = namedtuple(
+    'CompiledVariable', ['name', 'variable', 'operators', 'validate', 'decode', 'encode']
+)
 
-class TBase:
-    """Serial driver for the NAD T777 Sorround Receiver"""
+# Bits of CompiledVariable.operators
+_QUERY, _SET, _INCREMENT, _DECREMENT = 1, 2, 4, 8
+_OPERATOR_BITS = {'?': _QUERY, '=': _SET, '+': _INCREMENT, '-': _DECREMENT}
+
+# Priority lanes of CommandScheduler, most urgent first
+INTERACTIVE, NORMAL, BACKGROUND = 0, 1, 2
+
+
+def _accept_any(value):
+    return True
+
+
+def _compile_validator(possible_values):
+    """Return a validate(value) -> bool function specialised to possible_values"""
+    # None and the '<VALUE>' placeholder mean that any value is accepted
+    if possible_values is None or '<VALUE>' in possible_values:
+        return _accept_any
+
+    if isinstance(possible_values, range):
+        def validate(value):
+            try:
+                return int(value) in possible_values
+            except (TypeError, ValueError):
+                return False
+        return validate
+
+    members = frozenset(possible_values)
+
+    def validate(value):
+        return str(value) in members
+    return validate
+
+
+def _identity(text):
+    return text
+
+
+def _decode_int(text):
+    try:
+        return int(text)
+    except ValueError:
+        return text
+
+
+def _encode_int(value):
+    """Return the canonical text of an integer, e.g. '4' for 4, '04', '+4' or ' 4'"""
+    try:
+        number = int(value)
+    except (TypeError, ValueError):
+        return str(value)
+    # Leave e.g. 4.5 as is, for the validator to reject
+    if isinstance(value, str) or number == value:
+        return str(number)
+    return str(value)
+
+
+def _compile_codec(possible_values):
+    """Return decode(text) -> value and encode(value) -> text for possible_values
+
+    A range is decoded to int, {'On', 'Off'} and {'Yes', 'No'} to bool, a set of
+    numbers such as {'0', '0.1', '0.2'} to int or float, and anything else is kept as
+    str. Text that does not fit, e.g. from a newer firmware, is returned as is.
+    """
+    if possible_values is None or '<VALUE>' in possible_values:
+        return _identity, str
+    if isinstance(possible_values, range):
+        return _decode_int, _encode_int
+
+    if possible_values in ({'On', 'Off'}, {'Yes', 'No'}):
+        true, false = sorted(possible_values, key=lambda text: text in ('Off', 'No'))
+        values = {true: True, false: False}
+    else:
+        try:
+            values = {
+                text: float(text) if '.' in text else int(text)
+                for text in possible_values
+            }
+        except ValueError:
+            return _identity, str
+    texts = {value: text for text, value in values.items()}
+    decode_table, encode_table = values.get, texts.get
+
+    def decode(text):
+        return decode_table(text, text)
+
+    def encode(value):
+        return str(encode_table(value, value))
+    return decode, encode
 
-    specification = {
+
+def compile_specification(specification, base=None):
+    """Compile specification into a frozen {name: CompiledVariable} index
+
+    Names are interned and the operators are turned into a bitmask, so checking a
+    command costs a dict lookup and a bitwise and. The value codecs are built here
+    too, see _compile_codec. Entries of the base index that
+    were compiled from the same Variable are reused.
+    """
+    index = {}
+    for name, variable in specification.items():
+        compiled = base.get(name) if base is not None else None
+        if compiled is None or compiled.variable is not variable:
+            operators = 0
+            for operator in variable.operators:
+                operators |= _OPERATOR_BITS[operator]
+            name = sys.intern(name)
+            possible_values = variable.possible_values
+            compiled = CompiledVariable(
+                name, variable, operators, _compile_validator(possible_values),
+                *_compile_codec(possible_values)
+            )
+        index[compiled.name] = compiled
+    return types.MappingProxyType(index)
+
+
+class _LazySpecification:
+    """Class attribute holding a specification that is built when first used
+
+    build() returns the specification dict. The dict and its compiled index (see
+    compile_specification) are built once, on first access, and then cached, so
+    importing the module and using one model does not pay for the others.
+    """
+
+    def __init__(self, build):
+        self._build = build
+        self._lock = threading.Lock()
+        self._specification = None
+        self._index = None
+        self._byte_index = None
+        self._prefixes = None
+        self._owner = None
+
+    def __set_name__(self, owner, name):
+        self._owner = owner
+
+    def __get__(self, instance, owner):
+        if self._specification is None:
+            with self._lock:
+                if self._specification is None:
+                    self._specification = self._build()
+        return self._specification
+
+    def index(self):
+        if self._index is None:
+            specification = self.__get__(None, self._owner)
+            # Reuse the entries of a parent model that has already been compiled
+            base = None
+            for klass in self._owner.__mro__[1:]:
+                parent = klass.__dict__.get('specification')
+                if isinstance(parent, _LazySpecification):
+                    base = parent._index
+                    break
+            with self._lock:
+                if self._index is None:
+                    self._index = compile_specification(specification, base)
+        return self._index
+
+    def byte_index(self):
+        """Return the index keyed by the ascii encoded names, see ReplyParser"""
+        if self._byte_index is None:
+            self._byte_index = {
+                name.encode('ascii'): compiled for name, compiled in self.index().items()
+            }
+        return self._byte_index
+
+    def prefixes(self):
+        """Return {dotted prefix: names under it} of the index, see TBase.get_prefix
+
+        Every name is listed under itself and each of its parents, e.g. 'Main.Trim.
+        Center' under 'Main.Trim.Center', 'Main.Trim' and 'Main', so looking up the
+        variables of a prefix is one dict lookup.
+        """
+        if self._prefixes is None:
+            prefixes = {}
+            for name in sorted(self.index()):
+                prefix = name
+                while prefix:
+                    prefixes.setdefault(prefix, []).append(name)
+                    prefix = prefix.rpartition('.')[0]
+            self._prefixes = types.MappingProxyType({
+                prefix: tuple(names) for prefix, names in prefixes.items()
+            })
+        return self._prefixes
+
+
+def _base_specification():
+    """Return the specification shared by all the models"""
+    return {
         'DSP.Version': Variable(
             'Query DSP Version',
             None,
@@ -1066,62 +1263,1519 @@ class TBase:
         ),
     }
 
-    _invalid_operator_base_error = (
+
+def _escape_label(value):
+    """Escape \\, " and newlines in a Prometheus label value"""
+    value = str(value).replace('\\', '\\\\').replace('"', '\\"')
+    return value.replace('\n', '\\n')
+
+
+class _VariableStats:
+    __slots__ = ('commands', 'timeouts', 'retries', 'latency_sum', 'buckets')
+
+    def __init__(self, buckets):
+        self.commands = self.timeouts = self.retries = 0
+        self.latency_sum = 0.0
+        self.buckets = [0] * len(buckets)
+
+
+class Instrumentation:
+    """Per variable counters and latency histograms of the commands sent by a TBase
+
+    Pass an instance as TBase(..., instrumentation=...) to turn it on. The state is
+    exposed by snapshot() as a dict and by prometheus() in the Prometheus text
+    format. labels are added to every Prometheus sample, e.g. {'receiver': 'den'}.
+    """
+
+    # Upper bounds in seconds of the buckets of the latency histograms
+    buckets = (
+        0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, math.inf,
+    )
+
+    def __init__(self, labels=None):
+        self.labels = dict(labels or {})
+        self._lock = threading.Lock()
+        self._variables = {}
+        # bytes_in is only updated by the reader thread, so it is not locked, but
+        # any thread can write, see wrote
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def _stats(self, name):
+        stats = self._variables.get(name)
+        if stats is None:
+            stats = self._variables.setdefault(name, _VariableStats(self.buckets))
+        return stats
+
+    def observe(self, name, latency):
+        """Record a command for name answered after latency seconds"""
+        bucket = bisect.bisect_left(self.buckets, latency)
+        with self._lock:
+            stats = self._stats(name)
+            stats.commands += 1
+            stats.latency_sum += latency
+            stats.buckets[bucket] += 1
+
+    def wrote(self, count):
+        """Record count bytes written to the receiver"""
+        with self._lock:
+            self.bytes_out += count
+
+    def timeout(self, name):
+        with self._lock:
+            self._stats(name).timeouts += 1
+
+    def retry(self, name):
+        with self._lock:
+            self._stats(name).retries += 1
+
+    def snapshot(self):
+        """Return all the counters as a dict that can be serialised as JSON"""
+        with self._lock:
+            variables = {
+                name: {
+                    'commands': stats.commands,
+                    'timeouts': stats.timeouts,
+                    'retries': stats.retries,
+                    'latency_sum_s': stats.latency_sum,
+                    'latency_buckets': {
+                        str(bound): count
+                        for bound, count in zip(self.buckets, stats.buckets)
+                    },
+                }
+                for name, stats in self._variables.items()
+            }
+        return {
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'variables': variables,
+        }
+
+    def _labels(self, **extra):
+        labels = dict(self.labels, **extra)
+        if not labels:
+            return ''
+        return '{{{}}}'.format(
+            ','.join(
+                '{}="{}"'.format(key, _escape_label(value))
+                for key, value in labels.items()
+            )
+        )
+
+    def prometheus(self, prefix='nad'):
+        """Return the counters in the Prometheus text exposition format"""
+        snapshot = self.snapshot()
+        lines = []
+        for counter, help_ in (
+            ('commands', 'Commands answered'),
+            ('timeouts', 'Commands that timed out'),
+            ('retries', 'Commands that were sent again after a timeout'),
+        ):
+            metric = '{}_{}_total'.format(prefix, counter)
+            lines.append('# HELP {} {}'.format(metric, help_))
+            lines.append('# TYPE {} counter'.format(metric))
+            for name, variable in snapshot['variables'].items():
+                lines.append('{}{} {}'.format(
+                    metric, self._labels(variable=name), variable[counter]
+                ))
+
+        metric = '{}_command_latency_seconds'.format(prefix)
+        lines.append('# HELP {} Round trip time of answered commands'.format(metric))
+        lines.append('# TYPE {} histogram'.format(metric))
+        for name, variable in snapshot['variables'].items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, variable['latency_buckets'].values()):
+                cumulative += count
+                le = '+Inf' if bound == math.inf else repr(bound)
+                lines.append('{}_bucket{} {}'.format(
+                    metric, self._labels(variable=name, le=le), cumulative
+                ))
+            lines.append('{}_sum{} {!r}'.format(
+                metric, self._labels(variable=name), variable['latency_sum_s']
+            ))
+            lines.append('{}_count{} {}'.format(
+                metric, self._labels(variable=name), variable['commands']
+            ))
+
+        for direction in ('in', 'out'):
+            metric = '{}_bytes_{}_total'.format(prefix, direction)
+            lines.append('# HELP {} Bytes {} on the serial line'.format(
+                metric, 'read' if direction == 'in' else 'written'
+            ))
+            lines.append('# TYPE {} counter'.format(metric))
+            lines.append('{}{} {}'.format(
+                metric, self._labels(), snapshot['bytes_' + direction]
+            ))
+        return '\n'.join(lines) + '\n'
+
+
+class SerialTransport:
+    """Transport over a local serial port, e.g. '/dev/ttyUSB0'
+
+    A transport has write(data), read() which blocks until some data is available
+    and returns all of it (or b'' after cancel_read), cancel_read() and close().
+    """
+
+    def __init__(self, device, baudrate=115200):
+        self.device = device
+        self.serial = serial.Serial(device, baudrate)
+
+    def write(self, data):
+        self.serial.write(data)
+
+    def read(self):
+        # Block until the first byte arrives, then take whatever is waiting
+        data = self.serial.read(1)
+        if data:
+            data += self.serial.read(self.serial.in_waiting)
+        return data
+
+    def cancel_read(self):
+        self.serial.cancel_read()
+
+    def close(self):
+        self.serial.close()
+
+    def __str__(self):
+        return self.device
+
+
+class TCPTransport:
+    """Transport over a raw TCP socket, e.g. to an RS-232 to Ethernet bridge
+
+    The connection uses TCP keepalive. When it is lost it is made again, with an
+    exponential backoff from 0.1 s up to max_backoff seconds between attempts. A
+    transport from a TCPPool goes back to the pool on close instead of closing.
+    """
+
+    def __init__(self, host, port, connect_timeout=5.0, max_backoff=5.0, pool=None):
+        self.host = host
+        self.port = port
+        self.connect_timeout = connect_timeout
+        self.max_backoff = max_backoff
+        self.pool = pool
+        self._socket = None
+        self._lock = threading.Lock()
+        self._wake_read, self._wake_write = os.pipe()
+        self._closed = False
+        try:
+            self._connect()
+        except BaseException:
+            os.close(self._wake_read)
+            os.close(self._wake_write)
+            raise
+
+    def _connect(self):
+        import socket
+        with self._lock:
+            if self._socket is None:
+                sock = socket.create_connection(
+                    (self.host, self.port), self.connect_timeout
+                )
+                sock.settimeout(None)
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+                for option, value in (
+                    ('TCP_KEEPIDLE', 10), ('TCP_KEEPINTVL', 5), ('TCP_KEEPCNT', 3)
+                ):
+                    if hasattr(socket, option):
+                        option = getattr(socket, option)
+                        sock.setsockopt(socket.IPPROTO_TCP, option, value)
+                self._socket = sock
+            return self._socket
+
+    def _disconnect(self, sock):
+        with self._lock:
+            if self._socket is sock:
+                self._socket = None
+        sock.close()
+
+    def _reconnect(self):
+        """Connect with backoff, return False if cancel_read or close came first"""
+        backoff = 0.1
+        while not self._closed:
+            try:
+                self._connect()
+                return True
+            except OSError:
+                ready, _, _ = select.select([self._wake_read], [], [], backoff)
+                if ready:
+                    os.read(self._wake_read, 1024)
+                    return False
+                backoff = min(2 * backoff, self.max_backoff)
+        return False
+
+    def write(self, data):
+        for attempt in range(2):
+            sock = self._socket or self._connect()
+            try:
+                sock.sendall(data)
+                return
+            except OSError:
+                self._disconnect(sock)
+                if attempt:
+                    raise
+
+    def read(self):
+        while not self._closed:
+            sock = self._socket
+            if sock is None:
+                if not self._reconnect():
+                    return b''
+                continue
+            ready, _, _ = select.select([sock, self._wake_read], [], [])
+            if self._wake_read in ready:
+                os.read(self._wake_read, 1024)
+                return b''
+            try:
+                data = sock.recv(4096)
+            except OSError:
+                data = b''
+            if data:
+                return data
+            # The peer closed the connection
+            self._disconnect(sock)
+        return b''
+
+    def cancel_read(self):
+        os.write(self._wake_write, b'x')
+
+    def drain(self):
+        """Throw away bytes already received, e.g. late replies for a former user"""
+        sock = self._socket
+        if sock is None:
+            return
+        while select.select([sock], [], [], 0)[0]:
+            try:
+                if not sock.recv(4096):
+                    self._disconnect(sock)
+                    return
+            except OSError:
+                self._disconnect(sock)
+                return
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.release(self)
+            return
+        if self._closed:
+            return
+        self._closed = True
+        self.cancel_read()
+        sock = self._socket
+        if sock is not None:
+            self._disconnect(sock)
+        os.close(self._wake_read)
+        os.close(self._wake_write)
+
+    def __str__(self):
+        return 'tcp://{}:{}'.format(self.host, self.port)
+
+
+class TCPPool:
+    """Pool of TCPTransport connections keyed by host and port
+
+    Closing a transport from acquire returns the connection to the pool, and the
+    next acquire for the same host and port reuses it instead of connecting again.
+    Connections idle for more than max_idle seconds are closed.
+    """
+
+    def __init__(self, max_idle=60.0, **transport_options):
+        self.max_idle = max_idle
+        self.transport_options = transport_options
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, host, port):
+        self._expire()
+        with self._lock:
+            idle = self._idle.get((host, port))
+            transport = idle.pop()[0] if idle else None
+        if transport is None:
+            return TCPTransport(host, port, pool=self, **self.transport_options)
+        transport.drain()
+        return transport
+
+    def release(self, transport):
+        """Put transport back in the pool, releasing it again is ignored"""
+        with self._lock:
+            idle = self._idle.setdefault((transport.host, transport.port), [])
+            if all(entry[0] is not transport for entry in idle):
+                idle.append((transport, time.monotonic()))
+
+    def _expire(self):
+        oldest = time.monotonic() - self.max_idle
+        with self._lock:
+            expired = [
+                transport for idle in self._idle.values()
+                for transport, released in idle if released < oldest
+            ]
+            for key in list(self._idle):
+                self._idle[key] = [
+                    entry for entry in self._idle[key] if entry[1] >= oldest
+                ]
+        for transport in expired:
+            transport.pool = None
+            transport.close()
+
+    def close(self):
+        """Close all the idle connections"""
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for entries in idle.values():
+            for transport, _ in entries:
+                transport.pool = None
+                transport.close()
+
+
+# The pool used for 'tcp://host:port' devices
+tcp_pool = TCPPool()
+
+
+def open_transport(device):
+    """Return a transport for device
+
+    A transport object is returned as is, 'tcp://host:port' gives a connection from
+    tcp_pool and anything else is opened as a serial port.
+    """
+    if not isinstance(device, str):
+        return device
+    if device.startswith('tcp://'):
+        host, _, port = device[len('tcp://'):].rpartition(':')
+        return tcp_pool.acquire(host, int(port))
+    return SerialTransport(device)
+
+
+# Record of a recording file: kind (b'S' session start, b'w' written, b'r' read),
+# nanoseconds since the start of the session and data length, then the data
+_RECORD_FORMAT = '<cQI'
+
+
+def iter_recording(path):
+    """Yield the (kind, nanoseconds, data) records of a file from RecordingTransport"""
+    import struct
+    record = struct.Struct(_RECORD_FORMAT)
+    with open(path, 'rb') as file_:
+        while True:
+            header = file_.read(record.size)
+            if len(header) < record.size:
+                return
+            kind, nanoseconds, length = record.unpack(header)
+            yield kind, nanoseconds, file_.read(length)
+
+
+class RecordingTransport:
+    """Transport wrapper that appends every byte written and read to a file
+
+        receiver = T777(RecordingTransport(open_transport('/dev/ttyUSB0'), 'den.rec'))
+
+    Each write and each read is one binary record with the time since the start
+    of the session in nanoseconds (time.monotonic_ns), see iter_recording. Every
+    session starts with a b'S' record holding the name of the transport, so one
+    file can collect many sessions. Records are flushed as they are written.
+    """
+
+    def __init__(self, transport, path):
+        import struct
+        self.transport = transport
+        self.path = path
+        self._record = struct.Struct(_RECORD_FORMAT)
+        self._lock = threading.Lock()
+        self._file = open(path, 'ab')
+        self._start = time.monotonic_ns()
+        self._append(b'S', str(transport).encode('utf-8'))
+
+    def _append(self, kind, data):
+        with self._lock:
+            nanoseconds = time.monotonic_ns() - self._start
+            self._file.write(self._record.pack(kind, nanoseconds, len(data)) + data)
+            self._file.flush()
+
+    def write(self, data):
+        self._append(b'w', data)
+        self.transport.write(data)
+
+    def read(self):
+        data = self.transport.read()
+        if data:
+            self._append(b'r', data)
+        return data
+
+    def cancel_read(self):
+        self.transport.cancel_read()
+
+    def close(self):
+        self.transport.close()
+        with self._lock:
+            self._file.close()
+
+    def __str__(self):
+        return str(self.transport)
+
+
+class ReplayTransport:
+    """Transport that plays the bytes read in a recording back to a client
+
+    The recording comes from RecordingTransport, all of its sessions one after the
+    other. The client is expected to write what was written in the recording: a
+    read is not played before as many bytes have been written as before it in the
+    recording, so replies do not overtake their commands. The written bytes are
+    only counted, not compared. With realtime, every read is also delayed from the
+    write or read before it by the recorded time, divided by speed. Otherwise
+    everything is played as fast as the client goes. read blocks once the
+    recording is over, finished tells whether it is.
+    """
+
+    def __init__(self, path, realtime=True, speed=1.0):
+        self.path = path
+        self.realtime = realtime
+        self.speed = speed
+        self._records = [
+            record for record in iter_recording(path) if record[0] != b'S'
+        ]
+        self._position = 0
+        self._expected = 0
+        self._written = 0
+        self._written_at = time.monotonic()
+        # Time and recorded nanoseconds of the last record that was played
+        self._anchor = (time.monotonic(), 0)
+        self._condition = threading.Condition()
+        self._cancelled = False
+
+    @property
+    def finished(self):
+        return self._position >= len(self._records)
+
+    def write(self, data):
+        with self._condition:
+            self._written += len(data)
+            self._written_at = time.monotonic()
+            self._condition.notify_all()
+
+    def read(self):
+        with self._condition:
+            while not self._cancelled:
+                if self.finished:
+                    self._condition.wait()
+                    continue
+                kind, nanoseconds, data = self._records[self._position]
+                if kind == b'w':
+                    if self._written < self._expected + len(data):
+                        self._condition.wait()
+                        continue
+                    self._expected += len(data)
+                    self._anchor = (self._written_at, nanoseconds)
+                    self._position += 1
+                    continue
+                if self.realtime:
+                    played_at, played_nanoseconds = self._anchor
+                    delay = max(nanoseconds - played_nanoseconds, 0) / 1e9 / self.speed
+                    due = played_at + delay
+                    now = time.monotonic()
+                    if due > now:
+                        self._condition.wait(due - now)
+                        continue
+                    self._anchor = (due, nanoseconds)
+                self._position += 1
+                return data
+            self._cancelled = False
+            return b''
+
+    def cancel_read(self):
+        with self._condition:
+            self._cancelled = True
+            self._condition.notify_all()
+
+    def close(self):
+        pass
+
+    def __str__(self):
+        return 'replay of {}'.format(self.path)
+
+
+class ReplyParser:
+    """Streaming parser of the '\\rname=value\\r' lines sent by the receiver
+
+    feed appends the bytes read to one buffer and returns the (name, value) pairs of
+    the complete lines in it. The lines are sliced out of a memoryview of the buffer
+    and the consumed bytes are dropped once per feed, so there is no copy per line
+    besides the key of the name lookup and the value. Names are looked up in index,
+    {ascii encoded name: CompiledVariable}, so known names are not decoded at all
+    and their values come out decoded to int, float or bool by the variable codec.
+    Lines without '=' (echoed commands) and empty lines are skipped.
+    """
+
+    def __init__(self, index):
+        self.index = index
+        self._buffer = bytearray()
+
+    def feed(self, data):
+        buffer = self._buffer
+        buffer += data
+        replies = []
+        start = 0
+        end = buffer.find(b'\x0d')
+        if end < 0:
+            return replies
+        index = self.index
+        with memoryview(buffer) as view:
+            while end >= 0:
+                # Skip the \n and spaces that some firmwares send around lines
+                while start < end and buffer[start] in b' \n':
+                    start += 1
+                separator = buffer.find(b'=', start, end)
+                if separator > start:
+                    key = bytes(view[start:separator])
+                    # strip returns the same str when there is nothing to strip.
+                    # Line noise must not break the stream, so bad bytes become
+                    # U+FFFD
+                    value = str(view[separator + 1:end], 'ascii', 'replace').strip()
+                    compiled = index.get(key)
+                    if compiled is None:
+                        name = key.decode('ascii', 'replace').rstrip()
+                        replies.append((name, value))
+                    else:
+                        replies.append((compiled.name, compiled.decode(value)))
+                start = end + 1
+                end = buffer.find(b'\x0d', start)
+        del buffer[:start]
+        return replies
+
+
+class Namespace:
+    """The variables of a receiver under a dotted prefix, e.g. receiver.Zone2
+
+    Attributes go one level down, receiver.Main.Trim is the namespace of 'Main.Trim'.
+    snapshot and restore act on all the variables under the prefix, get, set,
+    increment and decrement on the variable named by the prefix itself:
+
+        receiver.Zone2.snapshot()
+        receiver.Zone2.Volume.set(-20)
+    """
+
+    def __init__(self, receiver, prefix):
+        self.receiver = receiver
+        self.prefix = prefix
+
+    def __getattr__(self, segment):
+        if segment[:1].isupper():
+            prefix = '{}.{}'.format(self.prefix, segment)
+            if prefix in self.receiver._lazy_specification().prefixes():
+                return Namespace(self.receiver, prefix)
+        raise AttributeError(
+            "'{}' has no variables under '{}.{}'".format(
+                type(self.receiver).__name__, self.prefix, segment
+            )
+        )
+
+    def __dir__(self):
+        start = len(self.prefix) + 1
+        children = {
+            name[start:].partition('.')[0] for name in self.names if name != self.prefix
+        }
+        return sorted(children) + list(super().__dir__())
+
+    def __repr__(self):
+        return '<Namespace {} of {}>'.format(self.prefix, type(self.receiver).__name__)
+
+    @property
+    def names(self):
+        return self.receiver._lazy_specification().prefixes()[self.prefix]
+
+    def snapshot(self, timeout=None, max_age=None):
+        return self.receiver.get_prefix(self.prefix, timeout=timeout, max_age=max_age)
+
+    def restore(self, state, timeout=None, max_age=None):
+        names = set(self.names)
+        state = {name: value for name, value in state.items() if name in names}
+        return self.receiver.restore(state, timeout=timeout, max_age=max_age)
+
+    def get(self, timeout=None, max_age=None):
+        return self.receiver.get(self.prefix, timeout=timeout, max_age=max_age)
+
+    def set(self, value, timeout=None):
+        return self.receiver.set(self.prefix, value, timeout=timeout)
+
+    def increment(self, timeout=None):
+        return self.receiver.increment(self.prefix, timeout=timeout)
+
+    def decrement(self, timeout=None):
+        return self.receiver.decrement(self.prefix, timeout=timeout)
+
+
+class Snapshot(dict):
+    """{name: value} of a receiver state, see TBase.snapshot
+
+    missing lists the names that were not answered.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.missing = []
+
+
+class TBase:
+    """Serial driver for the NAD T777 Sorround Receiver"""
+
+    specification = _LazySpecification(_base_specification)
+
+    _invalid_operator_base = (
         "The variable '{{0}}' cannot be {0}. To check if a variable can be {0}, check "
         "whether the '{1}' operator is present in .specification[{{0}}].operators. For "
         "this variable, valid operators are: {{1}}"
     )
     invalid_query_error = _invalid_operator_base.format('queried', '?')
-    invalid_set_error = _invalid_operator_base.format('queried', '=')
-    invalid_increment_error = _invalid_operator_base.format('queried', '+')
-    invalid_decrement_error = _invalid_operator_base.format('queried', '-')
+    invalid_set_error = _invalid_operator_base.format('set', '=')
+    invalid_increment_error = _invalid_operator_base.format('incremented', '+')
+    invalid_decrement_error = _invalid_operator_base.format('decremented', '-')
+    invalid_value_error = (
+        "'{0}' is not a valid value for '{1}'. Valid values are the ones in "
+        ".specification[{1}].possible_values: {2}"
+    )
+    # Queried after power on until it is answered, see __init__
+    readiness_probe = 'Main.Model'
+    probe_interval = 0.5
+
+    unconfirmed_set_error = (
+        "'{0}' was set to '{1}' but the receiver reports {2!r}"
+    )
+
+
+    def __init__(self, serial_device, timeout=1.0, cache=False, coalesce=None,
+                 debounce=False, retries=0, instrumentation=None, threaded=False,
+                 warm_up=15.0):
+        """Open serial_device, with an optional cache of the receiver state
+
+        serial_device is a serial port like '/dev/ttyUSB0', 'tcp://host:port' for a
+        pooled connection to a serial to Ethernet bridge, or a transport object, see
+        open_transport.
+
+        With cache=True, self.cache mirrors the receiver state as
+        {name: (value, time.monotonic() of the update)} from every reply and
+        unsolicited notification, and get(name, max_age=...) is answered from it.
 
+        With coalesce set to a number of seconds, increment and decrement return a
+        future right away, and all the steps of a variable made within that window
+        are sent as a single 'name=target' write, see increment.
 
-    def __init__(self, serial_device):
-        self.serial = serial.Serial(
-            serial_device,
-            115200,
+        With debounce=True, set returns a future, and a value set while a write to
+        the same variable is in flight replaces the one queued behind it, so only
+        the latest value is sent, see set.
+
+        Queries and sets that time out are sent again up to retries times. Pass an
+        Instrumentation to collect counters and latency histograms of the commands.
+
+        With threaded=True the receiver can be shared by many threads. A single
+        worker thread does all the writes, in the priority order of a
+        CommandScheduler, while the callers wait for their own replies, so commands
+        from different threads are pipelined on the line. submit also becomes
+        available.
+
+        After power on the receiver ignores commands while it boots. When
+        'Main.Power=On' is written, or notified while the power was known to be
+        off, the commands that follow are held, and readiness_probe is queried
+        every probe_interval seconds. Once the receiver answers, the held commands
+        are written in one burst, and the timeouts of their replies only start
+        then. After warm_up seconds without an answer they are written anyway.
+        warm_up=None turns this off.
+        """
+        self._init_state(timeout, cache, coalesce, debounce)
+        self.warm_up = warm_up
+        self.retries = retries
+        self.instrumentation = instrumentation
+        self._scheduler = CommandScheduler(self) if threaded else None
+        self.transport = open_transport(serial_device)
+        self._reader = threading.Thread(
+            target=self._read_loop,
+            name='NAD reader {}'.format(self.transport),
+            daemon=True,
         )
+        self._reader.start()
+
+    def _init_state(self, timeout, cache, coalesce=None, debounce=False):
+        """Set up the state shared by the synchronous and the asyncio clients"""
+        self.timeout = timeout
+        self.cache = {} if cache else None
+        self.coalesce = coalesce
+        self._steps = {}
+        # Names with a flush of their steps in flight
+        self._stepping = set()
+        self.debounce = debounce
+        self._writes = {}
+        self._acks = {}
+        self._ack_errors = {}
+        # (deadline, name, future) of the writes in _acks, oldest first
+        self._ack_deadlines = deque()
+        self._ack_timer = None
+        self._index = self._compiled_index()
+        self._parser = ReplyParser(self._lazy_specification().byte_index())
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._subscribers = []
+        # _closed is also set by the reader when the transport breaks, _shut only
+        # by close, which must not release the transport twice
+        self._closed = False
+        self._shut = False
+        self.retries = 0
+        self.instrumentation = None
+        self._scheduler = None
+        self._executor = None
+        self.warm_up = None
+        self._power = None
+        # Commands held during warm up, None when not warming up
+        self._held = None
+        self._gate = threading.RLock()
+        self._awake = threading.Event()
+        self._awake.set()
+        self._probe_answered = threading.Event()
+
+    def com(self, command, expect_reply=True, timeout=None, priority=NORMAL,
+            deadline=None):
+        """Send command and return the value from the 'name=value' reply
 
-    def com(self, command, expect_reply=True):
-        self.serial.write('\x0d{}\x0d'.format(command).encode('ascii'))
+        The reply is delivered by the reader thread, which blocks in the transport
+        until a \\r terminated line arrives, so the cost of a round trip is the wire
+        time plus the latency of the receiver. If no reply arrives within timeout
+        seconds (default self.timeout) a TimeoutError is raised. priority and
+        deadline are used in threaded mode, see CommandScheduler.submit.
+        """
+        data = '\x0d{}\x0d'.format(command).encode('ascii')
         if not expect_reply:
+            self._run(self._send, [], data, priority=priority, deadline=deadline)
+            return
+
+        name = command.split('=')[0].rstrip('?+-')
+        instrumentation = self.instrumentation
+        # Steps are not idempotent, so only queries and sets are retried
+        attempts = 1 + self.retries if command[len(name)] in '?=' else 1
+        for attempt in range(attempts):
+            start = time.perf_counter()
+            future, = self._run(
+                self._send, [name], data, priority=priority, deadline=deadline
+            )
+            try:
+                value = self._wait(name, future, timeout)
+            except TimeoutError:
+                if instrumentation is not None:
+                    instrumentation.timeout(name)
+                if attempt + 1 == attempts:
+                    raise
+                if instrumentation is not None:
+                    instrumentation.retry(name)
+                continue
+            if instrumentation is not None:
+                instrumentation.observe(name, time.perf_counter() - start)
+            return value
+
+    def submit(self, command, priority=NORMAL, deadline=None, timeout=None):
+        """Queue command and return a future of the value of its reply
+
+        Only available in threaded mode, see __init__. The future is resolved by a
+        small pool of threads that wait for the replies.
+        """
+        if self._scheduler is None:
+            raise RuntimeError('submit needs a TBase created with threaded=True')
+        if self._executor is None:
+            import concurrent.futures
+            with self._lock:
+                if self._executor is None:
+                    self._executor = concurrent.futures.ThreadPoolExecutor(
+                        max_workers=8, thread_name_prefix='NAD submit'
+                    )
+        return self._executor.submit(
+            self.com, command, True, timeout, priority, deadline
+        )
+
+    def _run(self, function, *args, priority=NORMAL, deadline=None):
+        """Call function(*args) in the worker thread in threaded mode, else directly"""
+        scheduler = self._scheduler
+        if scheduler is None or threading.current_thread() is scheduler._dispatcher:
+            return function(*args)
+        future = scheduler.submit(function, *args, priority=priority, deadline=deadline)
+        return future.result()
+
+    def _send(self, names, data):
+        """Register a future for the reply to each of names, write data, return them
+
+        Registering and writing happen together, so that in threaded mode the
+        futures of a name are registered in the order its commands are written.
+        """
+        futures = [self._expect(name) for name in names]
+        try:
+            with self._gate:
+                if self._held is None and self._power is not True and self.warm_up:
+                    # Write up to the power on and hold the rest
+                    end = data.find(b'Main.Power=On\x0d')
+                    if end >= 0:
+                        end += len(b'Main.Power=On\x0d')
+                        self._write(data[:end])
+                        self._start_warm_up()
+                        data = data[end:]
+                if self._held is not None:
+                    self._held += data
+                elif data:
+                    self._write(data)
+        except BaseException:
+            for name, future in zip(names, futures):
+                self._forget(name, future)
+            raise
+        return futures
+
+    def get_many(self, names, timeout=None, max_age=None, priority=NORMAL,
+                 missing=None):
+        """Query all of names in one burst and return a dict of name: value
+
+        All the queries are written back-to-back and the replies are demultiplexed
+        by name as they stream in, so the total cost is about one round trip plus
+        the transfer time, instead of one round trip per name. Names with a cached
+        value younger than max_age seconds are not queried. priority is the lane
+        used in threaded mode, see CommandScheduler. If missing is a list, the names
+        without a reply are added to it instead of raising TimeoutError.
+        """
+        names = list(dict.fromkeys(names))
+        replies = self._cached(names, max_age)
+        replies.update(self._pipeline({
+            name: self._query_command(name) for name in names if name not in replies
+        }, timeout, priority, missing))
+        return replies
+
+    def get_prefix(self, prefix, timeout=None, max_age=None):
+        """Query every variable under the dotted prefix, e.g. 'Zone2' or 'Main.Trim'
+
+        The names come from a prefix index built once per model, and the queries are
+        pipelined like get_many. A trailing '.' or '.*' is ignored.
+        """
+        prefix = prefix.rstrip('*').rstrip('.')
+        names = self._lazy_specification().prefixes().get(prefix)
+        if names is None:
+            raise ValueError(
+                "No variable names start with '{}'. Valid prefix.variable names are "
+                "keys the dict stored in the 'specification' property".format(prefix)
+            )
+        index = self._index
+        return self.get_many(
+            [name for name in names if index[name].operators & _QUERY],
+            timeout=timeout, max_age=max_age,
+        )
+
+    def set_many(self, values, timeout=None):
+        """Set all of {name: value} in one burst and return the values reported back
+
+        Like get_many, the writes are sent back-to-back and the replies
+        demultiplexed by name as they arrive.
+        """
+        return self._pipeline({
+            name: self._set_command(name, value) for name, value in values.items()
+        }, timeout)
+
+    def _pipeline(self, commands, timeout, priority=NORMAL, missing=None):
+        """Write {name: command} in one burst and return {name: value} of the replies
+
+        If missing is a list, the names without a reply are added to it instead of
+        raising TimeoutError, see _missed.
+        """
+        names = list(commands)
+        data = ''.join('\x0d{}\x0d'.format(command) for command in commands.values())
+        instrumentation = self.instrumentation
+        replies = {}
+        previous = time.perf_counter()
+        futures = self._run(self._send, names, data.encode('ascii'), priority=priority)
+        if instrumentation is not None:
+            # Each reply is timed from the one before it, not from the start of the
+            # burst, so the histograms show how slow a variable is and not where it
+            # was in the burst
+            arrivals = [None] * len(futures)
+            for position, future in enumerate(futures):
+                future.add_done_callback(
+                    lambda _, position=position:
+                    arrivals.__setitem__(position, time.perf_counter())
+                )
+        # The replies arrive in order, so timeout bounds the wait for each next one
+        try:
+            for position, (name, future) in enumerate(zip(names, futures)):
+                try:
+                    replies[name] = self._wait(name, future, timeout)
+                except TimeoutError:
+                    if instrumentation is not None:
+                        instrumentation.timeout(name)
+                    if missing is None:
+                        raise
+                    if self._missed(names, futures, position, missing):
+                        break
+                    continue
+                if instrumentation is not None:
+                    arrival = arrivals[position] or time.perf_counter()
+                    instrumentation.observe(name, max(arrival - previous, 0.0))
+                    previous = arrival
+        finally:
+            for name, future in zip(names, futures):
+                self._forget(name, future)
+        return replies
+
+    @staticmethod
+    def _missed(names, futures, position, missing):
+        """Add the name at position to missing, return True to stop waiting
+
+        The replies arrive in order, so if none of the later ones has arrived by
+        now either, the receiver has stopped answering and they are all missing.
+        """
+        if any(future.done() for future in futures[position + 1:]):
+            missing.append(names[position])
+            return False
+        missing.extend(names[position:])
+        return True
+
+    def _write(self, data):
+        self.transport.write(data)
+        if self.instrumentation is not None:
+            self.instrumentation.wrote(len(data))
+
+    def subscribe(self, callback):
+        """Call callback(name, value) for every line the receiver sends on its own
+
+        That is e.g. 'Main.Volume=-20' when the volume knob is turned. Callbacks are
+        called from the reader thread and should return quickly.
+        """
+        with self._lock:
+            self._subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        with self._lock:
+            self._subscribers.remove(callback)
+
+    def _new_future(self):
+        import concurrent.futures
+        return concurrent.futures.Future()
+
+    def _expect(self, name):
+        """Register and return a future for the next 'name=value' line"""
+        future = self._new_future()
+        with self._lock:
+            if self._closed:
+                raise ConnectionError('The connection is closed')
+            self._pending.setdefault(name, deque()).append(future)
+        return future
+
+    def _forget(self, name, future):
+        with self._lock:
+            waiters = self._pending.get(name)
+            if waiters and future in waiters:
+                waiters.remove(future)
+                if not waiters:
+                    del self._pending[name]
+
+    def _wait(self, name, future, timeout):
+        if timeout is None:
+            timeout = self.timeout
+        import concurrent.futures
+        try:
+            return future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            pass
+        if not self._awake.is_set():
+            # Held during warm up, the timeout starts again once it is written
+            self._awake.wait(self.warm_up)
+            try:
+                return future.result(timeout)
+            except concurrent.futures.TimeoutError:
+                pass
+        self._forget(name, future)
+        message = "No reply for {} within {} s"
+        raise TimeoutError(message.format([name], timeout))
+
+    def _reply_received(self, name, value):
+        """Route a reply to the oldest request waiting for it, or to the subscribers"""
+        if self.cache is not None:
+            self.cache[name] = (value, time.monotonic())
+        if name == 'Main.Power':
+            if value is True and self._power is False:
+                # Turned on from the front panel or a remote
+                self._start_warm_up()
+            self._power = value
+        elif name == self.readiness_probe and self._held is not None:
+            self._probe_answered.set()
+        with self._lock:
+            waiters = self._pending.get(name)
+            if waiters:
+                future = waiters.popleft()
+                if not waiters:
+                    del self._pending[name]
+            else:
+                future = None
+                subscribers = list(self._subscribers)
+        if future is not None:
+            future.set_result(value)
             return
+        for callback in subscribers:
+            try:
+                callback(name, value)
+            except Exception:
+                import logging
+                logging.getLogger(__name__).exception(
+                    'Subscriber %r failed on %s=%s', callback, name, value
+                )
+
+    def _read_loop(self):
+        parser = self._parser
+        try:
+            while not self._closed:
+                chunk = self.transport.read()
+                if not chunk:
+                    continue
+                if self.instrumentation is not None:
+                    self.instrumentation.bytes_in += len(chunk)
+                for name, value in parser.feed(chunk):
+                    try:
+                        self._reply_received(name, value)
+                    except Exception:
+                        import logging
+                        logging.getLogger(__name__).exception(
+                            'Failed to handle %s=%s', name, value
+                        )
+        except Exception as exception:
+            if not self._closed:
+                # The transport is broken, so fail the commands at once from now on
+                # rather than let them time out
+                with self._lock:
+                    self._closed = True
+                self._fail_pending(exception)
+
+    def _start_warm_up(self):
+        with self._gate:
+            if self._held is not None or not self.warm_up:
+                return
+            self._held = bytearray()
+            self._awake.clear()
+            self._probe_answered.clear()
+        threading.Thread(
+            target=self._probe_loop,
+            name='NAD warm up {}'.format(self.transport),
+            daemon=True,
+        ).start()
+
+    def _probe_loop(self):
+        """Query readiness_probe until it is answered, then write the held commands"""
+        probe = '\x0d{}?\x0d'.format(self.readiness_probe).encode('ascii')
+        deadline = time.monotonic() + self.warm_up
+        try:
+            while not self._closed and time.monotonic() < deadline:
+                with self._gate:
+                    self._write(probe)
+                if self._probe_answered.wait(self.probe_interval):
+                    break
+            with self._gate:
+                held = self._held
+                if held and not self._closed:
+                    self._write(bytes(held))
+        finally:
+            with self._gate:
+                self._held = None
+            self._awake.set()
 
-        reply = b''
-        while len(reply) == 0 or reply[-1] != 0x0d:  # \n
-            reply += self.serial.read(self.serial.inWaiting())
-            time.sleep(0.01)
+    def _fail_pending(self, exception):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        for waiters in pending.values():
+            for future in waiters:
+                future.set_exception(exception)
+
+    def close(self):
+        with self._lock:
+            if self._shut:
+                return
+            self._shut = True
+        if self._executor is not None:
+            self._executor.shutdown()
+        if self._scheduler is not None:
+            self._scheduler.close()
+        self._closed = True
+        self._probe_answered.set()
+        with self._lock:
+            if self._ack_timer is not None:
+                self._ack_timer.cancel()
+        self.transport.cancel_read()
+        self._reader.join()
+        self.transport.close()
+        self._fail_pending(ConnectionError('The connection was closed'))
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # Also make a plain dict specification in a subclass lazy and compiled
+        specification = cls.__dict__.get('specification')
+        if isinstance(specification, dict):
+            lazy = _LazySpecification(lambda: specification)
+            lazy.__set_name__(cls, 'specification')
+            cls.specification = lazy
+
+    def __getattr__(self, name):
+        # Only called for missing attributes, receiver.Zone2 is a Namespace
+        if name[:1].isupper() and name in self._lazy_specification().prefixes():
+            return Namespace(self, name)
+        raise AttributeError(
+            "'{}' object has no attribute '{}'".format(type(self).__name__, name)
+        )
 
-        return reply.decode('ascii').replace(command, '').strip()
+    @classmethod
+    def _lazy_specification(cls):
+        for klass in cls.__mro__:
+            if 'specification' in klass.__dict__:
+                return klass.__dict__['specification']
 
-    def get(self, name):
-        if name not in self.specification:
+    @classmethod
+    def _compiled_index(cls):
+        return cls._lazy_specification().index()
+
+    def _variable(self, name, operator, error):
+        """Return the compiled variable for name after checking operator is allowed"""
+        compiled = self._index.get(name)
+        if compiled is None:
             message = (
                 "'{}' is not a valid prefix.variable name. Valid prefix.variable names "
                 "are keys the dict stored in the 'specification' property"
             )
             raise ValueError(message.format(name))
-        variable = self.specification[name]
-        if '?' not in variable.operators:
-            message = (
+        if not compiled.operators & operator:
+            raise ValueError(error.format(name, compiled.variable.operators))
+        return compiled
+
+    def _query_command(self, name):
+        self._variable(name, _QUERY, self.invalid_query_error)
+        return name + '?'
+
+    def _set_command(self, name, value):
+        compiled = self._variable(name, _SET, self.invalid_set_error)
+        text = compiled.encode(value)
+        if not compiled.validate(text):
+            possible_values = compiled.variable.possible_values
+            raise ValueError(
+                self.invalid_value_error.format(value, name, possible_values)
             )
-            raise ValueError(message.format(name, variable.operators))
+        return '{}={}'.format(name, text)
 
-    def set(self, name value):
-        pass
+    def _step_command(self, name, operator):
+        if operator == '+':
+            self._variable(name, _INCREMENT, self.invalid_increment_error)
+        else:
+            self._variable(name, _DECREMENT, self.invalid_decrement_error)
+        return name + operator
 
-    def increment(self, name):
-        pass
+    def _cached(self, names, max_age):
+        """Return {name: value} for those of names cached within the last max_age s"""
+        if self.cache is None or max_age is None:
+            return {}
+        oldest = time.monotonic() - max_age
+        fresh = {}
+        for name in names:
+            value, updated = self.cache.get(name, (None, -math.inf))
+            if updated >= oldest:
+                fresh[name] = value
+        return fresh
 
-    def decrement(self, name):
-        pass
+    def get(self, name, timeout=None, max_age=None):
+        """Query the receiver for the value of name
 
-    def __getattr__(self, name):
-        print("__getattr__", name)
+        The value is decoded by the codec of the variable: int for a range, bool for
+        On/Off and Yes/No, int or float for numbers and str otherwise. If the state
+        is cached and the cached value is younger than max_age seconds,
+        it is returned without touching the serial line.
+        """
+        cached = self._cached([name], max_age)
+        if cached:
+            self._variable(name, _QUERY, self.invalid_query_error)
+            return cached[name]
+        return self.com(self._query_command(name), timeout=timeout)
+
+    def set(self, name, value, timeout=None, wait=True):
+        """Set name to value and return the value reported back by the receiver
+
+        value can be given as decoded by get (e.g. True for 'On') or as the text. The
+        receiver answers a write with the resulting 'name=value', which confirms it
+        and updates the cache, so no query is needed: if the value differs from the
+        one written a ValueError is raised. If debouncing is on (see __init__) a
+        future of that value is returned right away instead. A worker thread sends
+        the value, and then, until none is left, the latest value queued by calls
+        made meanwhile. Those calls only replace the queued value, and their futures
+        resolve with the result of the write that replaced their value.
 
-    def __setattr__(self, name, value):
-        print("__getattr__", name)
+        With wait=False the command is sent right away and None is returned. The
+        reply is checked by the reader thread when it arrives, see confirm. A write
+        without a reply within self.timeout seconds is failed with TimeoutError.
+        """
+        command = self._set_command(name, value)
+        if not wait:
+            self._set_nowait(name, command)
+            return None
+        if not self.debounce:
+            return self._confirmed(command, self.com(command, timeout=timeout))
+
+        future = self._new_future()
+        with self._lock:
+            # None while a write is in flight with nothing queued behind it
+            queued = self._writes.get(name)
+            if queued is not None:
+                queued[0] = command
+                queued[1].append(future)
+                return future
+            drain = name not in self._writes
+            self._writes[name] = [command, [future]]
+        if drain:
+            threading.Thread(
+                target=self._drain_writes,
+                args=(name, timeout),
+                name='NAD debounce {}'.format(name),
+                daemon=True,
+            ).start()
+        return future
+
+    def _drain_writes(self, name, timeout):
+        """Send the queued value of name until none is left, see set"""
+        while True:
+            with self._lock:
+                queued = self._writes[name]
+                if queued is None:
+                    del self._writes[name]
+                    return
+                command, futures = queued
+                self._writes[name] = None
+            try:
+                value = self._confirmed(command, self.com(command, timeout=timeout))
+            except Exception as exception:
+                for waiting in futures:
+                    waiting.set_exception(exception)
+            else:
+                for waiting in futures:
+                    waiting.set_result(value)
+
+    def _confirmed(self, command, value):
+        """Return value, the reply to the 'name=text' command, if it confirms text"""
+        name, _, text = command.partition('=')
+        if self._index[name].encode(value) != text:
+            raise ValueError(self.unconfirmed_set_error.format(name, text, value))
+        return value
+
+    def _set_nowait(self, name, command):
+        data = '\x0d{}\x0d'.format(command).encode('ascii')
+        future, = self._run(self._send, [name], data)
+        with self._lock:
+            self._acks[future] = command
+            self._ack_deadlines.append((time.monotonic() + self.timeout, name, future))
+            if self._ack_timer is None:
+                self._ack_timer = threading.Timer(self.timeout, self._expire_acks)
+                self._ack_timer.daemon = True
+                self._ack_timer.start()
+        future.add_done_callback(self._check_ack)
+
+    def _expire_acks(self):
+        """Forget the writes made with set(..., wait=False) whose reply is overdue
+
+        Otherwise a lost reply would leave its future first in line for the next
+        reply to the same name.
+        """
+        now = time.monotonic()
+        expired = []
+        with self._lock:
+            deadlines = self._ack_deadlines
+            while deadlines and deadlines[0][0] <= now:
+                _, name, future = deadlines.popleft()
+                if self._acks.pop(future, None) is not None:
+                    expired.append((name, future))
+            if deadlines and not self._closed:
+                self._ack_timer = threading.Timer(
+                    deadlines[0][0] - now, self._expire_acks
+                )
+                self._ack_timer.daemon = True
+                self._ack_timer.start()
+            else:
+                self._ack_timer = None
+        message = "No reply for {} within {} s"
+        for name, future in expired:
+            self._forget(name, future)
+            with self._lock:
+                self._ack_errors[name] = TimeoutError(
+                    message.format([name], self.timeout)
+                )
+
+    def _check_ack(self, future):
+        """Check the reply to a write made with set(..., wait=False)"""
+        with self._lock:
+            command = self._acks.pop(future, None)
+        if command is None or future.cancelled():
+            return
+        try:
+            self._confirmed(command, future.result())
+        except Exception as exception:
+            with self._lock:
+                self._ack_errors[command.partition('=')[0]] = exception
+
+    def confirm(self, timeout=None):
+        """Wait for the replies to the writes made with set(..., wait=False)
+
+        The replies are checked as they arrive, this waits up to timeout seconds
+        (default self.timeout) in all for the ones still missing. Returns {name:
+        exception} of the writes that failed since the last call, e.g. a ValueError
+        if the receiver reports another value, or a TimeoutError. It is empty if all
+        the writes were confirmed.
+        """
+        if timeout is None:
+            timeout = self.timeout
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            acks = dict(self._acks)
+        for future, command in acks.items():
+            name = command.partition('=')[0]
+            try:
+                self._wait(name, future, max(deadline - time.monotonic(), 0))
+            except TimeoutError:
+                message = "No reply for {} within {} s".format([name], timeout)
+                with self._lock:
+                    if self._acks.pop(future, None) is not None:
+                        self._ack_errors[name] = TimeoutError(message)
+            except Exception:
+                # Recorded by _check_ack
+                pass
+        with self._lock:
+            errors, self._ack_errors = self._ack_errors, {}
+        return errors
+
+    def increment(self, name, timeout=None):
+        """Step name up and return the new value
+
+        If coalescing is on (see __init__) a future of the new value is returned
+        instead, and the steps are folded together with the other steps of name in
+        the coalescing window.
+        """
+        command = self._step_command(name, '+')
+        if self.coalesce is not None:
+            return self._coalesce_step(name, 1)
+        return self.com(command, timeout=timeout)
+
+    def decrement(self, name, timeout=None):
+        """Step name down and return the new value, or a future of it, see increment"""
+        command = self._step_command(name, '-')
+        if self.coalesce is not None:
+            return self._coalesce_step(name, -1)
+        return self.com(command, timeout=timeout)
+
+    def _coalesce_step(self, name, step):
+        future = self._new_future()
+        with self._lock:
+            pending = self._steps.get(name)
+            if pending is None:
+                pending = self._steps[name] = [0, []]
+                # While a flush is in flight the steps are folded into the next
+                # one, which it makes when its write is answered
+                if name not in self._stepping:
+                    self._stepping.add(name)
+                    timer = threading.Timer(self.coalesce, self._flush_steps, (name,))
+                    timer.daemon = True
+                    timer.start()
+            pending[0] += step
+            pending[1].append(future)
+        return future
+
+    def _flush_steps(self, name):
+        """Apply the pending steps of name, and those that come in meanwhile"""
+        current = None
+        while True:
+            with self._lock:
+                pending = self._steps.pop(name, None)
+                if pending is None:
+                    self._stepping.discard(name)
+                    return
+            steps, futures = pending
+            try:
+                # Stepped from the value the last flush confirmed, the cache or a
+                # query could still be from before its write
+                current = self._apply_steps(name, steps, current)
+            except Exception as exception:
+                current = None
+                for future in futures:
+                    future.set_exception(exception)
+            else:
+                for future in futures:
+                    future.set_result(current)
+
+    def _apply_steps(self, name, steps, current=None):
+        """Apply the net number of steps to name and return the new value
+
+        current is the value of name if known, otherwise it is read.
+        """
+        compiled = self._index[name]
+        possible_values = compiled.variable.possible_values
+        readable_and_settable = compiled.operators & (_QUERY | _SET) == _QUERY | _SET
+        if isinstance(possible_values, range) and readable_and_settable:
+            # Step along the range from the current value, clamped to its ends
+            if current is None:
+                current = self.get(name, max_age=self.coalesce)
+            current = int(current)
+            position = (current - possible_values.start) // possible_values.step
+            position = min(max(position + steps, 0), len(possible_values) - 1)
+            target = possible_values[position]
+            if target == current:
+                return current
+            return self.com(self._set_command(name, target))
+
+        # Without a known range the net steps are sent one at a time
+        operator = '+' if steps > 0 else '-'
+        value = None
+        for _ in range(abs(steps)):
+            value = self.com(name + operator)
+        if value is None and compiled.operators & _QUERY:
+            value = self.get(name)
+        return value
+
+    def snapshot(self, timeout=None, max_age=None):
+        """Return the value of every variable that can be queried, as {name: value}
+
+        All the queries are pipelined, see get_many. The state is a Snapshot, a dict
+        of ints, floats, bools and strings, so it can be stored as e.g. JSON and
+        passed to restore later. A variable the receiver does not answer, e.g. one
+        that needs an add-on the unit does not have, does not fail the snapshot but
+        is listed in state.missing.
+        """
+        names = self._queryable()
+        state = Snapshot(self._cached(names, max_age))
+        state.update(self._pipeline({
+            name: self._query_command(name) for name in names if name not in state
+        }, timeout, missing=state.missing))
+        return state
+
+    def _queryable(self):
+        return [
+            name for name, compiled in self._index.items()
+            if compiled.operators & _QUERY
+        ]
+
+    def restore(self, state, timeout=None, max_age=None):
+        """Set the receiver back to a state from snapshot and return what was written
+
+        Only the variables that can be set, and whose current value differs from
+        the one in state, are written, in one pipelined burst. The current values
+        come from the cache if they are younger than max_age seconds, otherwise
+        they are queried, also in one burst. Variables this model does not have are
+        skipped.
+        """
+        settable, queryable = self._settable(state)
+        current = self.get_many(queryable, timeout=timeout, max_age=max_age)
+        return self.set_many(self._changed(settable, current), timeout=timeout)
+
+    def _settable(self, state):
+        """Return the {name: text} of state that can be set, and those to query"""
+        index = self._index
+        # Compared as encoded text, so a state with strings, e.g. from an older
+        # release, restores the same
+        settable = {
+            name: index[name].encode(value) for name, value in state.items()
+            if name in index and index[name].operators & _SET
+        }
+        return settable, [name for name in settable if index[name].operators & _QUERY]
+
+    def _changed(self, settable, current):
+        index = self._index
+        return {
+            name: value for name, value in settable.items()
+            if name not in current or index[name].encode(current[name]) != value
+        }
 
     #@property
     #def power(self):
@@ -1139,8 +2793,10 @@ class TBase:
     #def volume(self, value):
     #    self.com("Main.Volume={}".format(value), False)
 
-class T777(TBase):
-    specification = TBase.secification.copy()
+
+def _t777_specification():
+    """Return the specification of the T777"""
+    specification = TBase.specification.copy()
     specification.update({
         'Main.SpeakerA': Variable(
             'Set Speaker A On/Off',
@@ -1219,10 +2875,16 @@ class T777(TBase):
             {'Coaxial', 'Off', 'HDMI', 'Optical', 'ARC'},
         ),
     })
+    return specification
 
 
-class T787(TBase):
-    specification = TBase.secification.copy()
+class T777(TBase):
+    specification = _LazySpecification(_t777_specification)
+
+
+def _t787_specification():
+    """Return the specification of the T787"""
+    specification = TBase.specification.copy()
     specification.update({
         'Main.SpeakerA': Variable(
             'Set Speaker A On/Off',
@@ -1301,10 +2963,16 @@ class T787(TBase):
             {'Coaxial', 'Off', 'HDMI', 'Optical', 'ARC'},
         ),
     })
+    return specification
 
 
-class T187(TBase):
-    specification = TBase.secification.copy()
+class T787(TBase):
+    specification = _LazySpecification(_t787_specification)
+
+
+def _t187_specification():
+    """Return the specification of the T187"""
+    specification = TBase.specification.copy()
     specification.update({
         'Preset1.Setup.Display': Variable(
             'Set Preset to not include Display settings',
@@ -1375,11 +3043,667 @@ class T187(TBase):
             {'Coaxial', 'Off', 'HDMI', 'Optical', 'ARC'},
         ),
     })
+    return specification
+
+
+class T187(TBase):
+    specification = _LazySpecification(_t187_specification)
+
+
+MODELS = {model.__name__: model for model in (T777, T787, T187)}
+
+# {str(device): (model name, DSP version)} of the receivers identified by connect
+_identified = {}
+
+
+def connect(device, reprobe=False, **options):
+    """Open device and return a receiver of the model class matching the unit
+
+    The unit is identified with one pipelined burst of 'Main.Model?' and
+    'DSP.Version?'. The identification is cached per device, so connecting to it
+    again skips the probe unless reprobe is True. A unit that is not one of MODELS
+    is returned as a TBase. options are passed on to the class, see TBase.
+    """
+    key = str(device)
+    if key in _identified and not reprobe:
+        model_name, _ = _identified[key]
+        return MODELS.get(model_name, TBase)(device, **options)
+
+    receiver = TBase(device, **options)
+    try:
+        identity = receiver.get_many(['Main.Model', 'DSP.Version'])
+    except BaseException:
+        receiver.close()
+        raise
+    reported = identity['Main.Model'].replace(' ', '').upper()
+    model_name = next((name for name in MODELS if name in reported), None)
+    _identified[key] = (model_name, identity['DSP.Version'])
+    if model_name is not None:
+        # The models only differ in their specification, so the open connection is
+        # kept and just switched over to the class of the model
+        receiver.__class__ = MODELS[model_name]
+        receiver._index = receiver._compiled_index()
+        receiver._parser.index = receiver._lazy_specification().byte_index()
+    return receiver
+
+
+class AsyncSerialTransport:
+    """Non-blocking serial port driven by the readiness callbacks of an asyncio loop
+
+    The bytes that are read are passed to data_callback as they arrive. Must be
+    created from within a running event loop.
+    """
+
+    def __init__(self, serial_device, data_callback):
+        self.serial = serial.Serial(serial_device, 115200, timeout=0)
+        import asyncio
+        self._fd = self.serial.fileno()
+        os.set_blocking(self._fd, False)
+        self._data_callback = data_callback
+        self._loop = asyncio.get_running_loop()
+        self._write_buffer = bytearray()
+        self._loop.add_reader(self._fd, self._read_ready)
+
+    def _read_ready(self):
+        try:
+            data = os.read(self._fd, 4096)
+        except BlockingIOError:
+            return
+        self._data_callback(data)
+
+    def write(self, data):
+        if not self._write_buffer:
+            try:
+                written = os.write(self._fd, data)
+            except BlockingIOError:
+                written = 0
+            data = data[written:]
+            if not data:
+                return
+            self._loop.add_writer(self._fd, self._write_ready)
+        self._write_buffer += data
+
+    def _write_ready(self):
+        try:
+            written = os.write(self._fd, self._write_buffer)
+        except BlockingIOError:
+            return
+        del self._write_buffer[:written]
+        if not self._write_buffer:
+            self._loop.remove_writer(self._fd)
+
+    def close(self):
+        self._loop.remove_reader(self._fd)
+        if self._write_buffer:
+            self._loop.remove_writer(self._fd)
+        self.serial.close()
+
+
+class AsyncTBase(TBase):
+    """asyncio driver for the NAD T-series receivers
+
+    get, get_many, get_prefix, set, set_many, increment, decrement, snapshot and
+    restore are coroutines and no call blocks the event loop, so one process can
+    drive many receivers at once. Must be created from within a running event
+    loop. To use the specification of a specific model, combine it with the model
+    class:
+
+        class AsyncT777(AsyncTBase, T777):
+            pass
+    """
+
+    def __init__(self, serial_device, timeout=1.0, cache=False):
+        self._init_state(timeout, cache)
+        self.transport = AsyncSerialTransport(serial_device, self._data_received)
+
+    def _data_received(self, data):
+        for name, value in self._parser.feed(data):
+            self._reply_received(name, value)
+
+    def _new_future(self):
+        import asyncio
+        return asyncio.get_running_loop().create_future()
+
+    async def _wait(self, name, future, timeout):
+        if timeout is None:
+            timeout = self.timeout
+        import asyncio
+        # shield keeps wait_for from cancelling the future, it is forgotten instead
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), timeout)
+        except asyncio.TimeoutError:
+            self._forget(name, future)
+            message = "No reply for {} within {} s"
+            raise TimeoutError(message.format([name], timeout)) from None
+
+    async def com(self, command, expect_reply=True, timeout=None):
+        """Send command and return the value from the 'name=value' reply"""
+        if not expect_reply:
+            self.transport.write('\x0d{}\x0d'.format(command).encode('ascii'))
+            return
+        name = command.split('=')[0].rstrip('?+-')
+        future = self._expect(name)
+        self.transport.write('\x0d{}\x0d'.format(command).encode('ascii'))
+        return await self._wait(name, future, timeout)
+
+    async def get_many(self, names, timeout=None, max_age=None):
+        """Query all of names in one burst and return a dict of name: value"""
+        names = list(dict.fromkeys(names))
+        replies = self._cached(names, max_age)
+        replies.update(await self._pipeline({
+            name: self._query_command(name) for name in names if name not in replies
+        }, timeout))
+        return replies
+
+    async def set_many(self, values, timeout=None):
+        """Set all of {name: value} in one burst, like TBase.set_many"""
+        return await self._pipeline({
+            name: self._set_command(name, value) for name, value in values.items()
+        }, timeout)
+
+    async def _pipeline(self, commands, timeout, missing=None):
+        names = list(commands)
+        data = ''.join('\x0d{}\x0d'.format(command) for command in commands.values())
+        futures = [self._expect(name) for name in names]
+        self.transport.write(data.encode('ascii'))
+        replies = {}
+        # The replies arrive in order, so timeout bounds the wait for each next one
+        try:
+            for position, (name, future) in enumerate(zip(names, futures)):
+                try:
+                    replies[name] = await self._wait(name, future, timeout)
+                except TimeoutError:
+                    if missing is None:
+                        raise
+                    if self._missed(names, futures, position, missing):
+                        break
+        finally:
+            for name, future in zip(names, futures):
+                self._forget(name, future)
+        return replies
+
+    async def get(self, name, timeout=None, max_age=None):
+        """Query the receiver for the value of name, or use the cache like TBase.get"""
+        cached = self._cached([name], max_age)
+        if cached:
+            self._variable(name, _QUERY, self.invalid_query_error)
+            return cached[name]
+        return await self.com(self._query_command(name), timeout=timeout)
+
+    async def set(self, name, value, timeout=None):
+        """Set name to value and return the value reported back by the receiver"""
+        command = self._set_command(name, value)
+        return self._confirmed(command, await self.com(command, timeout=timeout))
+
+    async def snapshot(self, timeout=None, max_age=None):
+        """Return the value of every variable that can be queried, see TBase.snapshot"""
+        names = self._queryable()
+        state = Snapshot(self._cached(names, max_age))
+        state.update(await self._pipeline({
+            name: self._query_command(name) for name in names if name not in state
+        }, timeout, missing=state.missing))
+        return state
+
+    async def restore(self, state, timeout=None, max_age=None):
+        """Set the receiver back to a state from snapshot, see TBase.restore"""
+        settable, queryable = self._settable(state)
+        current = await self.get_many(queryable, timeout=timeout, max_age=max_age)
+        return await self.set_many(self._changed(settable, current), timeout=timeout)
+
+    async def increment(self, name, timeout=None):
+        """Step name up and return the new value"""
+        return await self.com(self._step_command(name, '+'), timeout=timeout)
+
+    async def decrement(self, name, timeout=None):
+        """Step name down and return the new value"""
+        return await self.com(self._step_command(name, '-'), timeout=timeout)
+
+    def close(self):
+        with self._lock:
+            if self._shut:
+                return
+            self._shut = True
+        self.transport.close()
+        self._fail_pending(ConnectionError('The connection was closed'))
+
+
+
+class CommandScheduler:
+    """Runs the calls of many threads on one receiver, in priority order
+
+    Calls are queued in three lanes, INTERACTIVE, NORMAL and BACKGROUND, and a
+    dispatcher thread always runs the oldest call of the most urgent non-empty
+    lane, so e.g. a volume change never waits behind a queue of polls:
+
+        scheduler = CommandScheduler(receiver)
+        scheduler.submit(receiver.set, 'Main.Volume', -20, priority=INTERACTIVE)
+        scheduler.submit(receiver.get_many, names, priority=BACKGROUND,
+                         deadline=time.monotonic() + 1.0)
+
+    Each lane holds at most maxsize calls. When a lane is full, submit blocks like
+    queue.Queue.put, and raises queue.Full if block is False or timeout expires.
+    A call whose deadline (a time.monotonic() value) has passed by its turn is
+    dropped, and its future fails with TimeoutError.
+    """
+
+    def __init__(self, receiver, maxsize=64):
+        self.receiver = receiver
+        self.maxsize = maxsize
+        self.dropped = 0
+        self._lanes = (deque(), deque(), deque())
+        self._condition = threading.Condition()
+        self._closed = False
+        self._dispatcher = threading.Thread(
+            target=self._dispatch, name='NAD scheduler', daemon=True
+        )
+        self._dispatcher.start()
+
+    def submit(self, function, *args, priority=NORMAL, deadline=None, block=True,
+               timeout=None):
+        """Queue function(*args) and return a future of its result"""
+        import queue
+        import concurrent.futures
+        future = concurrent.futures.Future()
+        lane = self._lanes[priority]
+        with self._condition:
+            if self._closed:
+                raise RuntimeError('The scheduler is closed')
+            if len(lane) >= self.maxsize:
+                self._drop_expired(lane)
+            if len(lane) >= self.maxsize:
+                if not block or not self._condition.wait_for(
+                    lambda: len(lane) < self.maxsize or self._closed, timeout
+                ):
+                    raise queue.Full('The {} lane is full'.format(priority))
+                if self._closed:
+                    raise RuntimeError('The scheduler is closed')
+            lane.append((future, deadline, function, args))
+            self._condition.notify_all()
+        return future
+
+    def _drop_expired(self, lane):
+        now = time.monotonic()
+        for job in [job for job in lane if job[1] is not None and job[1] < now]:
+            lane.remove(job)
+            self._drop(job[0])
+
+    def _drop(self, future):
+        self.dropped += 1
+        future.set_exception(
+            TimeoutError('Dropped, the deadline passed before it could be sent')
+        )
+
+    def _next_job(self):
+        with self._condition:
+            self._condition.wait_for(lambda: self._closed or any(self._lanes))
+            if self._closed:
+                return None
+            lane = next(lane for lane in self._lanes if lane)
+            job = lane.popleft()
+            # Make room for a submit blocked on a full lane
+            self._condition.notify_all()
+            return job
+
+    def _dispatch(self):
+        while True:
+            job = self._next_job()
+            if job is None:
+                return
+            future, deadline, function, args = job
+            if deadline is not None and deadline < time.monotonic():
+                with self._condition:
+                    self._drop(future)
+                continue
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                result = function(*args)
+            except BaseException as exception:
+                future.set_exception(exception)
+            else:
+                future.set_result(result)
+
+    def close(self):
+        """Stop the dispatcher and cancel the calls still queued"""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._dispatcher.join()
+        for lane in self._lanes:
+            while lane:
+                lane.popleft()[0].cancel()
+
+
+class _PolledVariable:
+    __slots__ = ('interval', 'due', 'value', 'polls', 'changes', 'misses', 'polled')
+
+    def __init__(self, interval, due):
+        self.interval = interval
+        self.due = due
+        self.value = None
+        self.polls = self.changes = self.misses = 0
+        self.polled = -math.inf
+
+
+class Poller:
+    """Polls the variables of a receiver that does not notify changes reliably
+
+    Every variable has its own polling interval, between min_interval and
+    max_interval seconds. It is halved when a poll finds a new value and grows by
+    growth when it does not, so e.g. Main.Volume ends up polled often and the setup
+    variables rarely. The due variables are queried in pipelined batches of at most
+    budget commands per second on average (a token bucket of one second of
+    budget), the most overdue first, at BACKGROUND priority in threaded mode.
+    Notifications sent by the receiver also update the known values.
+
+        poller = Poller(receiver, budget=5.0)
+        poller.subscribe(lambda name, value: print(name, value))
+
+    Callbacks are called with (name, value) like TBase.subscribe, for every value
+    that differs from the previous one, from the polling or the reader thread.
+    names defaults to every variable that can be queried. If other threads use the
+    receiver too, it should be created with threaded=True.
+
+    A variable that is not answered while the receiver answers others has its
+    interval doubled, and after max_misses such polls in a row it is no longer
+    polled, e.g. when it needs an add-on the unit does not have.
+    """
+
+    def __init__(self, receiver, budget=10.0, names=None, min_interval=1.0,
+                 max_interval=300.0, growth=1.5, timeout=None, max_misses=3):
+        self.receiver = receiver
+        self.budget = budget
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.growth = growth
+        self.timeout = timeout
+        self.max_misses = max_misses
+        if names is None:
+            names = [
+                name for name, compiled in receiver._index.items()
+                if compiled.operators & _QUERY
+            ]
+        else:
+            for name in names:
+                receiver._variable(name, _QUERY, receiver.invalid_query_error)
+        now = time.monotonic()
+        # Start from an even share of the budget, the intervals adapt from there
+        interval = min(max(min_interval, len(names) / budget), max_interval)
+        self._variables = {name: _PolledVariable(interval, now) for name in names}
+        self._queue = [(now, name) for name in sorted(self._variables)]
+        heapq.heapify(self._queue)
+        # When a poll last got a reply
+        self._answered = -math.inf
+        self._tokens = max(budget, 1.0)
+        self._refilled = now
+        self._subscribers = []
+        self._condition = threading.Condition()
+        self._closed = False
+        receiver.subscribe(self._notified)
+        self._thread = threading.Thread(
+            target=self._poll_loop, name='NAD poller', daemon=True
+        )
+        self._thread.start()
+
+    def subscribe(self, callback):
+        """Call callback(name, value) when a value is found to have changed"""
+        with self._condition:
+            self._subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        with self._condition:
+            self._subscribers.remove(callback)
+
+    def stats(self):
+        """Return {name: {'interval_s': ..., 'polls': ..., 'changes': ..., ...}}
+
+        misses is the number of polls in a row without a reply, see max_misses.
+        """
+        with self._condition:
+            return {
+                name: {
+                    'interval_s': variable.interval,
+                    'polls': variable.polls,
+                    'changes': variable.changes,
+                    'misses': variable.misses,
+                }
+                for name, variable in self._variables.items()
+            }
+
+    def _schedule(self, name, variable, due):
+        variable.due = due
+        heapq.heappush(self._queue, (due, name))
+
+    def _next_batch(self):
+        """Wait for due variables and budget, and return their (due, name) to poll"""
+        with self._condition:
+            while not self._closed:
+                now = time.monotonic()
+                self._tokens = min(
+                    max(self.budget, 1.0),
+                    self._tokens + (now - self._refilled) * self.budget,
+                )
+                self._refilled = now
+                # Entries of variables that were rescheduled since are stale
+                while self._queue and (
+                    self._variables[self._queue[0][1]].due != self._queue[0][0]
+                ):
+                    heapq.heappop(self._queue)
+                if not self._queue:
+                    self._condition.wait()
+                    continue
+                delay = self._queue[0][0] - now
+                if self._tokens < 1.0:
+                    delay = max(delay, (1.0 - self._tokens) / self.budget)
+                if delay > 0:
+                    self._condition.wait(delay)
+                    continue
+                batch = []
+                while self._queue and self._queue[0][0] <= now and (
+                    len(batch) < int(self._tokens)
+                ):
+                    due, name = heapq.heappop(self._queue)
+                    if self._variables[name].due == due:
+                        # Not due again until the poll is done
+                        self._variables[name].due = math.inf
+                        batch.append((due, name))
+                self._tokens -= len(batch)
+                if batch:
+                    return batch
+            return None
+
+    def _poll_loop(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            names = [name for _, name in batch]
+            missing = []
+            started = time.monotonic()
+            try:
+                values = self.receiver.get_many(
+                    names, timeout=self.timeout, priority=BACKGROUND, missing=missing
+                )
+            except Exception as exception:
+                values = {}
+                if self._closed:
+                    return
+                import logging
+                logging.getLogger(__name__).warning(
+                    'Polling %s failed: %r', ', '.join(names), exception
+                )
+            if values:
+                self._answered = time.monotonic()
+            changes = []
+            with self._condition:
+                for due, name in batch:
+                    variable = self._variables[name]
+                    previous, variable.polled = variable.polled, started
+                    # A miss counts if the receiver answered other polls since the
+                    # previous one, when it answers nothing it is off or unplugged
+                    if name in missing and self._answered > previous:
+                        variable.misses += 1
+                        if variable.misses >= self.max_misses:
+                            import logging
+                            logging.getLogger(__name__).warning(
+                                'Not polling %s anymore, it was not answered %d '
+                                'times in a row', name, variable.misses
+                            )
+                            continue
+                        variable.interval = min(
+                            self.max_interval, variable.interval * 2
+                        )
+                    elif name in values:
+                        variable.misses = 0
+                        value = values[name]
+                        if variable.value is not None and value != variable.value:
+                            variable.interval = max(
+                                self.min_interval, variable.interval / 2
+                            )
+                            variable.changes += 1
+                            changes.append((name, value))
+                        else:
+                            variable.interval = min(
+                                self.max_interval, variable.interval * self.growth
+                            )
+                        variable.value = value
+                        variable.polls += 1
+                    # From the due time rather than now, so that when the budget
+                    # is short every variable is late by the same amount of its
+                    # own interval, instead of the slow ones crowding the queue
+                    self._schedule(name, variable, due + variable.interval)
+                subscribers = list(self._subscribers)
+            self._emit(changes, subscribers)
+
+    def _notified(self, name, value):
+        """Take a value notified by the receiver, it need not be polled for now"""
+        with self._condition:
+            variable = self._variables.get(name)
+            if variable is None or variable.due == math.inf:
+                return
+            changed = variable.value is not None and value != variable.value
+            variable.value = value
+            self._schedule(name, variable, time.monotonic() + variable.interval)
+            subscribers = list(self._subscribers)
+        if changed:
+            self._emit([(name, value)], subscribers)
+
+    def _emit(self, changes, subscribers):
+        for name, value in changes:
+            for callback in subscribers:
+                try:
+                    callback(name, value)
+                except Exception:
+                    import logging
+                    logging.getLogger(__name__).exception(
+                        'Subscriber %r failed on %s=%s', callback, name, value
+                    )
+
+    def close(self):
+        """Stop polling, the receiver is left open"""
+        self.receiver.unsubscribe(self._notified)
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._thread.join()
+
+
+class Fleet:
+    """Many receivers, with calls fanned out to all or some of them in parallel
+
+        fleet = Fleet({'den': T777('/dev/ttyUSB0'), 'kitchen': T187('/dev/ttyUSB1')})
+        fleet.set('Zone2.Mute', 'On')
+        fleet.get_many(['Main.Volume', 'Main.Mute'], units=['den'])
+
+    Every receiver has its own thread, so a call on all units takes the wall time of
+    the slowest one rather than the sum. Calls return {unit: result}, where the
+    result of a unit that failed, or did not answer within timeout seconds
+    (default: wait for all), is the exception instead. The calls on one unit run
+    one at a time, so a call that outlives timeout delays the next calls on that
+    unit only.
+    """
+
+    def __init__(self, receivers, timeout=None):
+        import concurrent.futures
+        self.receivers = dict(receivers)
+        self.timeout = timeout
+        self._executors = {
+            unit: concurrent.futures.ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix='NAD fleet {}'.format(unit)
+            )
+            for unit in self.receivers
+        }
+
+    def call(self, method, *args, units=None, timeout=None):
+        """Call receiver.method(*args) on units (default all) and return the results"""
+        if units is None:
+            units = list(self.receivers)
+        futures = {unit: self._submit(unit, method, *args) for unit in units}
+        return self._gather(method, futures, timeout)
+
+    def _submit(self, unit, method, *args):
+        receiver = self.receivers[unit]
+        return self._executors[unit].submit(getattr(receiver, method), *args)
+
+    def _gather(self, method, futures, timeout):
+        import concurrent.futures
+        if timeout is None:
+            timeout = self.timeout
+        concurrent.futures.wait(futures.values(), timeout)
+        results = {}
+        for unit, future in futures.items():
+            if not future.done():
+                message = "{} on '{}' did not finish within {} s"
+                results[unit] = TimeoutError(message.format(method, unit, timeout))
+            elif future.exception() is not None:
+                results[unit] = future.exception()
+            else:
+                results[unit] = future.result()
+        return results
+
+    def get(self, name, units=None, timeout=None):
+        return self.call('get', name, units=units, timeout=timeout)
+
+    def set(self, name, value, units=None, timeout=None):
+        return self.call('set', name, value, units=units, timeout=timeout)
+
+    def increment(self, name, units=None, timeout=None):
+        return self.call('increment', name, units=units, timeout=timeout)
+
+    def decrement(self, name, units=None, timeout=None):
+        return self.call('decrement', name, units=units, timeout=timeout)
+
+    def get_many(self, names, units=None, timeout=None):
+        return self.call('get_many', names, units=units, timeout=timeout)
+
+    def get_prefix(self, prefix, units=None, timeout=None):
+        return self.call('get_prefix', prefix, units=units, timeout=timeout)
+
+    def set_many(self, values, units=None, timeout=None):
+        return self.call('set_many', values, units=units, timeout=timeout)
+
+    def snapshot(self, units=None, timeout=None):
+        return self.call('snapshot', units=units, timeout=timeout)
 
+    def restore(self, states, timeout=None):
+        """Restore {unit: state} as returned by snapshot, in parallel"""
+        futures = {
+            unit: self._submit(unit, 'restore', state)
+            for unit, state in states.items()
+        }
+        return self._gather('restore', futures, timeout)
 
-t747 = TBase('/dev/ttyUSB0')
-t747.volume
-#t747.volume=-11
-#print(t747.volume)
+    def close(self):
+        """Close all the receivers"""
+        for executor in self._executors.values():
+            executor.shutdown()
+        for receiver in self.receivers.values():
+            receiver.close()
 
 
+if __name__ == '__main__':
+    t747 = TBase(sys.argv[1] if len(sys.argv) > 1 else '/dev/ttyUSB0')
+    print(t747.get('Main.Volume'))
+    #t747.set('Main.Volume', -11)
+    #print(t747.get('Main.Volume'))
+    t747.close()
@@ -0,0 +1,216 @@
+
+import os
+import sys
+import pty
+import tty
+import random
+import time
+import select
+import argparse
+import threading
+
+from NAD_tXX7 import TBase, T777, T787, T187
+
+
+MODELS = {model.__name__: model for model in (TBase, T777, T787, T187)}
+
+
+class Simulator:
+    """Simulated NAD receiver answering the serial protocol on a pseudo-terminal
+
+    The state and the valid commands are taken from the specification of model.
+    Every command is answered after latency plus a random extra delay of up to
+    jitter seconds, one command at a time like the receiver does. With
+    events_per_second, random unsolicited 'name=value' notifications are sent, and
+    inject sends a specific one. When Main.Power is set from Off to On, the power
+    on is answered and then commands are ignored for warm_up seconds, like the
+    receiver does while it boots.
+
+        with Simulator(T777, latency=0.005) as simulator:
+            receiver = T777(simulator.port)
+    """
+
+    def __init__(self, model=TBase, latency=0.0, jitter=0.0, events_per_second=0.0,
+                 seed=None, warm_up=0.0):
+        self.model = model
+        self.specification = model.specification
+        self.latency = latency
+        self.jitter = jitter
+        self.events_per_second = events_per_second
+        self.warm_up = warm_up
+        self.booting_until = 0.0
+        self.random = random.Random(seed)
+        self.state = {
+            name: self._initial_value(name, variable)
+            for name, variable in self.specification.items()
+        }
+        self.commands = 0
+
+        self._master, self._slave = pty.openpty()
+        # No echo and no \r to \n translation
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+        self._write_lock = threading.Lock()
+        self._stop_read, self._stop_write = os.pipe()
+        self._closed = False
+        self._threads = [threading.Thread(target=self._serve, daemon=True)]
+        if events_per_second:
+            self._threads.append(threading.Thread(target=self._send_events, daemon=True))
+        for thread in self._threads:
+            thread.start()
+
+    def _initial_value(self, name, variable):
+        if name == 'Main.Model':
+            return self.model.__name__
+        if name == 'DSP.Version':
+            return '1.00'
+        if name == 'Main.Power':
+            return 'On'
+        possible_values = variable.possible_values
+        if possible_values is None or '<VALUE>' in possible_values:
+            return ''
+        if isinstance(possible_values, range):
+            return str(0 if 0 in possible_values else possible_values[0])
+        if 'Off' in possible_values:
+            return 'Off'
+        return sorted(possible_values)[0]
+
+    def _valid(self, variable, value):
+        possible_values = variable.possible_values
+        if possible_values is None or '<VALUE>' in possible_values:
+            return True
+        if isinstance(possible_values, range):
+            try:
+                return int(value) in possible_values
+            except ValueError:
+                return False
+        return value in possible_values
+
+    def _step(self, variable, value, step):
+        possible_values = variable.possible_values
+        if isinstance(possible_values, range):
+            position = (int(value) - possible_values.start) // possible_values.step
+            position = min(max(position + step, 0), len(possible_values) - 1)
+            return str(possible_values[position])
+        if possible_values is None or '<VALUE>' in possible_values:
+            return value
+        # Enums cycle through their values
+        values = sorted(possible_values)
+        position = values.index(value) if value in values else 0
+        return values[(position + step) % len(values)]
+
+    def answer(self, command):
+        """Apply command to the state and return the reply line, or None"""
+        for end, operator in enumerate(command):
+            if operator in '?=+-':
+                break
+        else:
+            return None
+        name, argument = command[:end], command[end + 1:]
+        variable = self.specification.get(name)
+        if variable is None or operator not in variable.operators:
+            return None
+        if time.monotonic() < self.booting_until:
+            return None
+
+        if operator == '=':
+            if self._valid(variable, argument):
+                if name == 'Main.Power' and argument == 'On' != self.state[name]:
+                    self.booting_until = time.monotonic() + self.warm_up
+                self.state[name] = argument
+        elif operator in '+-':
+            step = 1 if operator == '+' else -1
+            self.state[name] = self._step(variable, self.state[name], step)
+        return '{}={}'.format(name, self.state[name])
+
+    def inject(self, name, value):
+        """Change name to value, as from the front panel, and notify the client"""
+        compiled = self.model._compiled_index().get(name)
+        value = compiled.encode(value) if compiled is not None else str(value)
+        self.state[name] = value
+        self._send('{}={}'.format(name, value))
+
+    def _send(self, line):
+        with self._write_lock:
+            os.write(self._master, '\x0d{}\x0d'.format(line).encode('ascii'))
+
+    def _serve(self):
+        buffer = bytearray()
+        while not self._closed:
+            ready, _, _ = select.select([self._master, self._stop_read], [], [])
+            if self._stop_read in ready:
+                return
+            try:
+                buffer += os.read(self._master, 4096)
+            except OSError:
+                return
+            end = buffer.find(b'\x0d')
+            while end >= 0:
+                command = buffer[:end].decode('ascii').strip()
+                del buffer[:end + 1]
+                if command:
+                    self.commands += 1
+                    delay = self.latency + self.random.uniform(0, self.jitter)
+                    if delay:
+                        self._wait(delay)
+                    reply = self.answer(command)
+                    if reply is not None:
+                        self._send(reply)
+                end = buffer.find(b'\x0d')
+
+    def _send_events(self):
+        names = [
+            name for name, variable in self.specification.items()
+            if '=' in variable.operators and variable.possible_values is not None
+            and '<VALUE>' not in variable.possible_values
+        ]
+        while not self._wait(self.random.expovariate(self.events_per_second)):
+            name = self.random.choice(names)
+            value = self.random.choice(list(self.specification[name].possible_values))
+            self.inject(name, value)
+
+    def _wait(self, delay):
+        """Sleep for delay seconds, return True if the simulator was closed meanwhile"""
+        ready, _, _ = select.select([self._stop_read], [], [], delay)
+        return bool(ready)
+
+    def close(self):
+        self._closed = True
+        os.write(self._stop_write, b'x')
+        for thread in self._threads:
+            thread.join()
+        for fd in (self._master, self._slave, self._stop_read, self._stop_write):
+            os.close(fd)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def main():
+    """Run a simulator until stdin is closed, printing its port on the first line"""
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('--model', default='TBase', choices=sorted(MODELS))
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--events-per-second', type=float, default=0.0)
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--warm-up', type=float, default=0.0)
+    args = parser.parse_args()
+
+    with Simulator(
+        MODELS[args.model],
+        latency=args.latency,
+        jitter=args.jitter,
+        events_per_second=args.events_per_second,
+        seed=args.seed,
+        warm_up=args.warm_up,
+    ) as simulator:
+        print(simulator.port, flush=True)
+        sys.stdin.read()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+"""Latency and throughput benchmark of the command path against the simulator
+
+For each model, a simulator (see NAD_tXX7_simulator) is started in a separate
+process, so that its CPU time is not counted, and the client measures:
+
+ * latency: round trip percentiles of single get calls
+ * bulk_query: every queryable variable with get_many, and one get at a time
+ * set and increment throughput
+ * cpu_per_command: client process CPU time per command over all of the above
+
+The results are written as JSON, to compare transport changes between releases:
+
+    python benchmarks/command_path.py --output results.json
+"""
+
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import NAD_tXX7  # noqa: E402
+
+
+MODELS = ('T777', 'T787', 'T187')
+
+
+def percentiles(samples, points=(50, 90, 99)):
+    samples = sorted(samples)
+    last = len(samples) - 1
+    return {
+        'p{}_ms'.format(point): 1000 * samples[min(last, len(samples) * point // 100)]
+        for point in points
+    }
+
+
+def start_simulator(model, latency, jitter):
+    process = subprocess.Popen(
+        [
+            sys.executable, os.path.join(ROOT, 'NAD_tXX7_simulator.py'),
+            '--model', model, '--latency', str(latency), '--jitter', str(jitter),
+            '--seed', '0',
+        ],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        universal_newlines=True,
+    )
+    port = process.stdout.readline().strip()
+    return process, port
+
+
+def benchmark_model(model, args):
+    process, port = start_simulator(model, args.latency, args.jitter)
+    receiver = getattr(NAD_tXX7, model)(port)
+    try:
+        return run(receiver, args)
+    finally:
+        receiver.close()
+        process.stdin.close()
+        process.wait()
+
+
+def run(receiver, args):
+    result = {}
+    commands = 0
+    cpu_start = time.process_time()
+
+    latencies = []
+    for _ in range(args.count):
+        start = time.perf_counter()
+        receiver.get('Main.Volume')
+        latencies.append(time.perf_counter() - start)
+    commands += args.count
+    result['latency'] = percentiles(latencies)
+
+    names = [
+        name for name, variable in receiver.specification.items()
+        if '?' in variable.operators
+    ]
+    start = time.perf_counter()
+    receiver.get_many(names)
+    pipelined = time.perf_counter() - start
+    start = time.perf_counter()
+    for name in names:
+        receiver.get(name)
+    sequential = time.perf_counter() - start
+    commands += 2 * len(names)
+    result['bulk_query'] = {
+        'variables': len(names),
+        'get_many_s': pipelined,
+        'get_many_per_s': len(names) / pipelined,
+        'sequential_get_s': sequential,
+        'sequential_get_per_s': len(names) / sequential,
+    }
+
+    values = [-10, -8, -6, -4, -2, 0, 2, 4, 6, 8, 10]
+    start = time.perf_counter()
+    for index in range(args.count):
+        receiver.set('Main.Bass', values[index % len(values)])
+    result['set_per_s'] = args.count / (time.perf_counter() - start)
+    start = time.perf_counter()
+    for index in range(args.count):
+        if index % 2:
+            receiver.decrement('Main.Volume')
+        else:
+            receiver.increment('Main.Volume')
+    result['increment_per_s'] = args.count / (time.perf_counter() - start)
+    commands += 2 * args.count
+
+    result['commands'] = commands
+    result['cpu_per_command_us'] = 1e6 * (time.process_time() - cpu_start) / commands
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--models', nargs='+', default=MODELS, choices=MODELS)
+    parser.add_argument('--count', type=int, default=500,
+                        help='number of commands in the latency, set and increment runs')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='simulated receiver latency per command in seconds')
+    parser.add_argument('--jitter', type=float, default=0.0,
+                        help='simulated random extra latency per command in seconds')
+    parser.add_argument('--output', help='JSON file to write, default stdout')
+    args = parser.parse_args()
+
+    results = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'count': args.count,
+        'simulated_latency_s': args.latency,
+        'simulated_jitter_s': args.jitter,
+        'models': {model: benchmark_model(model, args) for model in args.models},
+    }
+    if args.output:
+        with open(args.output, 'w') as file_:
+            json.dump(results, file_, indent=4)
+    else:
+        print(json.dumps(results, indent=4))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+"""Import time benchmark for NAD_tXX7
+
+Every sample runs in a fresh interpreter and measures the time to import the module
+and then the time to first use of each model, i.e. to build and compile its
+specification. The medians are printed as JSON. With --max-import-ms the exit status
+is 1 if the median import time is above that limit, to hold the line in CI:
+
+    python benchmarks/import_time.py --repeat 20 --max-import-ms 50
+"""
+
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SAMPLE = '''
+import json, sys, time
+start = time.perf_counter()
+import NAD_tXX7
+times = {'import': time.perf_counter() - start}
+for model in ('TBase', 'T777', 'T787', 'T187'):
+    start = time.perf_counter()
+    getattr(NAD_tXX7, model)._compiled_index()
+    times[model] = time.perf_counter() - start
+print(json.dumps(times))
+'''
+
+
+def sample():
+    output = subprocess.run(
+        [sys.executable, '-c', SAMPLE],
+        cwd=ROOT,
+        check=True,
+        stdout=subprocess.PIPE,
+        universal_newlines=True,
+    ).stdout
+    return json.loads(output)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--max-import-ms', type=float)
+    args = parser.parse_args()
+
+    samples = [sample() for _ in range(args.repeat)]
+    result = {
+        '{}_ms'.format(key): 1000 * statistics.median(s[key] for s in samples)
+        for key in samples[0]
+    }
+    result['repeat'] = args.repeat
+    print(json.dumps(result, indent=4))
+
+    if args.max_import_ms is not None and result['import_ms'] > args.max_import_ms:
+        message = 'Median import time {:.1f} ms is above the limit of {} ms'
+        print(message.format(result['import_ms'], args.max_import_ms), file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
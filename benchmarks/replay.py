@@ -0,0 +1,122 @@
+"""Benchmark of the reply parser and the command path on a recorded session
+
+A recording is made with NAD_tXX7.RecordingTransport, e.g. in the field, or here
+against the simulator with --record. It is then replayed as fast as possible:
+
+ * parser: every chunk that was read, through ReplyParser
+ * client: the recorded commands written again by a client on a ReplayTransport,
+   each written chunk as one pipelined burst, as get_many and set_many send them
+
+    python benchmarks/replay.py den.rec --model T777
+    python benchmarks/replay.py session.rec --record --count 200
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import NAD_tXX7  # noqa: E402
+
+
+MODELS = ('TBase', 'T777', 'T787', 'T187')
+
+
+def record(path, model, count):
+    from NAD_tXX7_simulator import Simulator
+    with Simulator(model) as simulator:
+        transport = NAD_tXX7.RecordingTransport(
+            NAD_tXX7.open_transport(simulator.port), path
+        )
+        receiver = model(transport)
+        try:
+            names = [
+                name for name, variable in receiver.specification.items()
+                if '?' in variable.operators
+            ]
+            receiver.get_many(names)
+            for index in range(count):
+                receiver.get('Main.Volume')
+                receiver.set('Main.Bass', 2 * (index % 11) - 10)
+                receiver.increment('Main.Volume')
+        finally:
+            receiver.close()
+
+
+def bench_parser(model, path, repeat):
+    chunks = [data for kind, _, data in NAD_tXX7.iter_recording(path) if kind == b'r']
+    size = sum(len(chunk) for chunk in chunks)
+    replies = 0
+    start = time.perf_counter()
+    for _ in range(repeat):
+        parser = NAD_tXX7.ReplyParser(model._lazy_specification().byte_index())
+        for chunk in chunks:
+            replies += len(parser.feed(chunk))
+    elapsed = time.perf_counter() - start
+    return {
+        'bytes': size,
+        'replies_per_s': replies / elapsed,
+        'mb_per_s': repeat * size / elapsed / 1e6,
+    }
+
+
+def bench_client(model, path):
+    bursts = []
+    for kind, _, data in NAD_tXX7.iter_recording(path):
+        if kind == b'w':
+            commands = data.decode('ascii').split('\x0d')
+            bursts.append({
+                command.split('=')[0].rstrip('?+-'): command
+                for command in commands if command
+            })
+    receiver = model(NAD_tXX7.ReplayTransport(path, realtime=False))
+    commands = 0
+    try:
+        start = time.perf_counter()
+        cpu_start = time.process_time()
+        for burst in bursts:
+            receiver._pipeline(burst, None)
+            commands += len(burst)
+        elapsed = time.perf_counter() - start
+        cpu = time.process_time() - cpu_start
+    finally:
+        receiver.close()
+    return {
+        'commands': commands,
+        'commands_per_s': commands / elapsed,
+        'cpu_per_command_us': 1e6 * cpu / commands,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('recording')
+    parser.add_argument('--model', default='T777', choices=MODELS)
+    parser.add_argument('--record', action='store_true',
+                        help='first record a session against the simulator')
+    parser.add_argument('--count', type=int, default=500,
+                        help='number of get, set and increment rounds to record')
+    parser.add_argument('--repeat', type=int, default=20,
+                        help='number of passes of the parser over the recording')
+    args = parser.parse_args()
+
+    model = getattr(NAD_tXX7, args.model)
+    if args.record:
+        if os.path.exists(args.recording):
+            parser.error('{} exists, recordings are appended to'.format(args.recording))
+        record(args.recording, model, args.count)
+    results = {
+        'recording': args.recording,
+        'model': args.model,
+        'parser': bench_parser(model, args.recording, args.repeat),
+        'client': bench_client(model, args.recording),
+    }
+    print(json.dumps(results, indent=4))
+
+
+if __name__ == '__main__':
+    main()
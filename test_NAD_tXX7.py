@@ -0,0 +1,45 @@
+"""Tests against NAD_tXX7_simulator, run with python -m unittest or pytest"""
+
+import time
+import unittest
+import concurrent.futures
+
+import NAD_tXX7
+
+try:
+    from NAD_tXX7_simulator import Simulator
+except ImportError:
+    # pty is POSIX only
+    Simulator = None
+
+
+@unittest.skipIf(Simulator is None, 'the simulator needs a POSIX pseudo-terminal')
+class CoalesceTest(unittest.TestCase):
+
+    def step(self, cache):
+        with Simulator(NAD_tXX7.T777, latency=0.02) as simulator:
+            simulator.state['Main.Volume'] = '-60'
+            receiver = NAD_tXX7.T777(simulator.port, coalesce=0.02, cache=cache)
+            try:
+                futures = []
+                # Spread over many windows, so windows open while the write of the
+                # one before is in flight
+                for _ in range(40):
+                    futures.append(receiver.increment('Main.Volume'))
+                    time.sleep(0.005)
+                done, not_done = concurrent.futures.wait(futures, 10)
+                self.assertFalse(not_done)
+                self.assertEqual(futures[-1].result(), -20)
+                self.assertEqual(simulator.state['Main.Volume'], '-20')
+            finally:
+                receiver.close()
+
+    def test_no_steps_lost(self):
+        self.step(cache=False)
+
+    def test_no_steps_lost_with_cache(self):
+        self.step(cache=True)
+
+
+if __name__ == '__main__':
+    unittest.main()